@@ -4,16 +4,72 @@ Main entry point for the web application
 """
 
 from flask import Flask, render_template, request, jsonify
+from flask.json.provider import JSONProvider
+import orjson
 import config
-from models import sentiment_analyzer, emotion_analyzer, aspect_analyzer
+from models import sentiment_analyzer, emotion_analyzer, aspect_analyzer, result_cache, preload_models
 import utils
+from collections import deque
 from datetime import datetime
+import functools
+import itertools
+import os
+
+
+class ORJSONProvider(JSONProvider):
+    """Serve jsonify() and request.get_json() with orjson instead of stdlib json"""
+    
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, option=orjson.OPT_SERIALIZE_NUMPY).decode()
+    
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
 
 app = Flask(__name__)
+app.json = ORJSONProvider(app)
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
 
+# Per-endpoint body limits: JSON escapes a character outside the BMP (e.g. emoji)
+# as a surrogate pair \uXXXX\uXXXX, 12 bytes for one character, plus headroom
+# for the rest of the payload. Requests without a Content-Length skip this check
+# and fall back to MAX_CONTENT_LENGTH (Flask 3.0 has no per-request limit).
+MAX_TEXT_BODY = config.MAX_TEXT_LENGTH * 12 + 1024
+MAX_BATCH_BODY = config.BATCH_SIZE_LIMIT * config.MAX_TEXT_LENGTH * 12 + 1024
+
 # Store analysis history (in-memory, could use DB for production)
-analysis_history = []
+# Bounded so long-running processes drop the oldest entries instead of leaking;
+# deque appends are O(1) and thread-safe
+analysis_history = deque(maxlen=config.HISTORY_MAX)
+_history_ids = itertools.count(1)
+
+
+def _preview(text: str, max_length: int = 100) -> str:
+    """Truncate text for display in history"""
+    return text if len(text) <= max_length else text[:max_length] + '...'
+
+
+def _record_history(analysis_type: str, text: str, result: dict):
+    """Add an analysis to the history"""
+    analysis_history.append({
+        'id': next(_history_ids),
+        'text': _preview(text),
+        'type': analysis_type,
+        'result': result,
+        'timestamp': datetime.now().isoformat()
+    })
+
+
+def limit_content_length(max_bytes: int):
+    """Reject oversized request bodies from Content-Length, before reading or parsing them"""
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            if request.content_length and request.content_length > max_bytes:
+                return jsonify({'error': f'Request body exceeds limit of {max_bytes} bytes'}), 413
+            return view(*args, **kwargs)
+        return wrapper
+    return decorator
 
 
 @app.route('/')
@@ -23,6 +79,7 @@ def index():
 
 
 @app.route('/api/analyze', methods=['POST'])
+@limit_content_length(MAX_TEXT_BODY)
 def analyze():
     """
     Analyze sentiment of text
@@ -47,14 +104,7 @@ def analyze():
             return jsonify(result), 400
         
         # Add to history
-        history_entry = {
-            'id': len(analysis_history) + 1,
-            'text': text[:100] + '...' if len(text) > 100 else text,
-            'type': 'sentiment',
-            'result': result,
-            'timestamp': datetime.now().isoformat()
-        }
-        analysis_history.append(history_entry)
+        _record_history('sentiment', text, result)
         
         return jsonify(result)
     
@@ -66,6 +116,7 @@ def analyze():
 
 
 @app.route('/api/emotion', methods=['POST'])
+@limit_content_length(MAX_TEXT_BODY)
 def analyze_emotion():
     """
     Analyze emotions in text
@@ -86,14 +137,7 @@ def analyze_emotion():
             return jsonify(result), 400
         
         # Add to history
-        history_entry = {
-            'id': len(analysis_history) + 1,
-            'text': text[:100] + '...' if len(text) > 100 else text,
-            'type': 'emotion',
-            'result': result,
-            'timestamp': datetime.now().isoformat()
-        }
-        analysis_history.append(history_entry)
+        _record_history('emotion', text, result)
         
         return jsonify(result)
     
@@ -102,6 +146,7 @@ def analyze_emotion():
 
 
 @app.route('/api/aspect', methods=['POST'])
+@limit_content_length(MAX_TEXT_BODY)
 def analyze_aspect():
     """
     Perform aspect-based sentiment analysis
@@ -122,14 +167,7 @@ def analyze_aspect():
             return jsonify(result), 400
         
         # Add to history
-        history_entry = {
-            'id': len(analysis_history) + 1,
-            'text': text[:100] + '...' if len(text) > 100 else text,
-            'type': 'aspect',
-            'result': result,
-            'timestamp': datetime.now().isoformat()
-        }
-        analysis_history.append(history_entry)
+        _record_history('aspect', text, result)
         
         return jsonify(result)
     
@@ -138,6 +176,7 @@ def analyze_aspect():
 
 
 @app.route('/api/batch', methods=['POST'])
+@limit_content_length(MAX_BATCH_BODY)
 def batch_analyze():
     """
     Batch process multiple texts
@@ -156,18 +195,14 @@ def batch_analyze():
             return jsonify({'error': f'Batch size exceeds limit of {config.BATCH_SIZE_LIMIT}'}), 400
         
         # Process based on mode
-        results = []
-        for text in texts:
-            if mode == 'sentiment':
-                result = sentiment_analyzer.analyze_sentiment(text)
-            elif mode == 'emotion':
-                result = emotion_analyzer.analyze_emotion(text)
-            elif mode == 'aspect':
-                result = aspect_analyzer.analyze_aspects(text)
-            else:
-                result = {'error': 'Invalid mode'}
-            
-            results.append(result)
+        if mode == 'sentiment':
+            results = sentiment_analyzer.analyze_batch(texts)
+        elif mode == 'emotion':
+            results = emotion_analyzer.analyze_batch(texts)
+        elif mode == 'aspect':
+            results = [aspect_analyzer.analyze_aspects(text) for text in texts]
+        else:
+            results = [{'error': 'Invalid mode'} for _ in texts]
         
         return jsonify({
             'results': results,
@@ -184,7 +219,7 @@ def get_history():
     """Get analysis history"""
     limit = request.args.get('limit', 20, type=int)
     return jsonify({
-        'history': analysis_history[-limit:],
+        'history': list(analysis_history)[-limit:],
         'total': len(analysis_history)
     })
 
@@ -192,11 +227,17 @@ def get_history():
 @app.route('/api/clear-history', methods=['POST'])
 def clear_history():
     """Clear analysis history"""
-    global analysis_history
-    analysis_history = []
+    analysis_history.clear()
     return jsonify({'message': 'History cleared'})
 
 
+@app.route('/api/clear-cache', methods=['POST'])
+def clear_cache():
+    """Clear cached analysis results"""
+    result_cache.clear()
+    return jsonify({'message': 'Cache cleared'})
+
+
 @app.route('/health', methods=['GET'])
 def health():
     """Health check endpoint"""
@@ -206,7 +247,8 @@ def health():
         'models': {
             'sentiment': config.SENTIMENT_MODEL,
             'emotion': config.EMOTION_MODEL
-        }
+        },
+        'cache': result_cache.stats()
     })
 
 
@@ -219,6 +261,10 @@ if __name__ == '__main__':
     print(f"Emotion Model: {config.EMOTION_MODEL}")
     print("=" * 60)
     
+    # With the debug reloader, only the serving child process loads models
+    if config.PRELOAD_MODELS and (not config.DEBUG or os.environ.get('WERKZEUG_RUN_MAIN') == 'true'):
+        preload_models()
+    
     app.run(
         host=config.HOST,
         port=config.PORT,
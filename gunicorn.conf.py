@@ -0,0 +1,24 @@
+"""
+Gunicorn configuration for production serving
+Run with: gunicorn app:app
+"""
+
+import config
+
+bind = f"{config.HOST}:{config.PORT}"
+
+# One process so every thread shares a single copy of the models;
+# threads overlap tokenization and I/O with model execution
+workers = 1
+worker_class = "gthread"
+threads = 8
+
+# Model loading and torch.compile warm-up can exceed the default timeout
+timeout = 300
+
+
+def post_worker_init(worker):
+    """Load models before the worker starts accepting requests"""
+    if config.PRELOAD_MODELS:
+        from models import preload_models
+        preload_models()
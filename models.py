@@ -3,146 +3,496 @@ ML Models for Sentiment and Emotion Analysis
 Using pre-trained transformers from Hugging Face
 """
 
-from transformers import AutoTokenizer, AutoModelForSequenceClassification, pipeline
+from transformers import AutoTokenizer, AutoModelForSequenceClassification
+import contextlib
+import copy
+import functools
+import hashlib
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from collections import OrderedDict
+from datetime import datetime
 import torch
 import numpy as np
-from typing import Dict, List, Tuple
+from typing import Dict, List, Optional, Tuple
 import config
 import utils
 
+# Inference only: never track gradients, and cap intra-op threads so small
+# models don't pay thread-oversubscription costs on CPU
+torch.set_grad_enabled(False)
+torch.set_num_threads(min(config.CPU_NUM_THREADS, os.cpu_count() or 1))
 
-class SentimentAnalyzer:
-    """Sentiment Analysis using RoBERTa model"""
+try:
+    from optimum.bettertransformer import BetterTransformer
+except ImportError:
+    BetterTransformer = None
+
+try:
+    import onnxruntime
+    from optimum.onnxruntime import ORTModelForSequenceClassification, ORTQuantizer
+    from optimum.onnxruntime.configuration import AutoQuantizationConfig
+except ImportError:
+    ORTModelForSequenceClassification = None
+
+DEVICE = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+
+def _inference_dtype() -> torch.dtype:
+    """Half precision on GPU (bf16 where supported), full precision on CPU"""
+    if not torch.cuda.is_available():
+        return torch.float32
+    return torch.bfloat16 if torch.cuda.is_bf16_supported() else torch.float16
+
+
+def _autocast():
+    """Autocast context for GPU inference so nothing silently runs in FP32"""
+    if torch.cuda.is_available():
+        return torch.autocast("cuda", dtype=_inference_dtype())
+    return contextlib.nullcontext()
+
+
+def _load_onnx_classifier(model_name: str):
+    """
+    Load an ONNX Runtime export of the classifier for CPU inference
+    Exports (and optionally int8-quantizes) once into CACHE_DIR, then reuses it
+    Returns: ORT model, or None if ONNX Runtime is unavailable
+    """
+    if ORTModelForSequenceClassification is None:
+        return None
+    
+    export_dir = os.path.join(config.CACHE_DIR, 'onnx', model_name.replace('/', '--'))
+    file_name = "model_quantized.onnx" if config.ONNX_QUANTIZE else "model.onnx"
+    
+    try:
+        if not os.path.isfile(os.path.join(export_dir, file_name)):
+            print(f"Exporting {model_name} to ONNX: {export_dir}")
+            model = ORTModelForSequenceClassification.from_pretrained(model_name, export=True)
+            model.save_pretrained(export_dir)
+            
+            if config.ONNX_QUANTIZE:
+                # Dynamic int8 quantization (uses VNNI instructions where available)
+                quantizer = ORTQuantizer.from_pretrained(export_dir)
+                quantization_config = AutoQuantizationConfig.avx512_vnni(is_static=False, per_channel=False)
+                quantizer.quantize(save_dir=export_dir, quantization_config=quantization_config)
+        
+        # Same intra-op thread cap as torch; ORT defaults to one thread per core
+        session_options = onnxruntime.SessionOptions()
+        session_options.intra_op_num_threads = torch.get_num_threads()
+        
+        return ORTModelForSequenceClassification.from_pretrained(
+            export_dir,
+            file_name=file_name,
+            provider="CPUExecutionProvider",
+            session_options=session_options
+        )
+    except Exception as e:
+        print(f"ONNX Runtime unavailable, using PyTorch model: {str(e)}")
+        return None
+
+
+def _load_classifier(model_name: str) -> Tuple:
+    """Load a sequence classifier and tokenizer with fused attention kernels"""
+    dtype = _inference_dtype()
+    tokenizer = AutoTokenizer.from_pretrained(model_name)
+    
+    if config.USE_ONNX and not torch.cuda.is_available():
+        model = _load_onnx_classifier(model_name)
+        if model is not None:
+            return model, tokenizer
+    
+    try:
+        # Native scaled_dot_product_attention where the architecture supports it
+        model = AutoModelForSequenceClassification.from_pretrained(
+            model_name,
+            attn_implementation="sdpa",
+            torch_dtype=dtype
+        )
+    except (ValueError, TypeError):
+        # Fall back to BetterTransformer's fused encoder layers
+        model = AutoModelForSequenceClassification.from_pretrained(model_name, torch_dtype=dtype)
+        if BetterTransformer is not None:
+            try:
+                model = BetterTransformer.transform(model)
+            except Exception as e:
+                print(f"BetterTransformer unavailable, using eager attention: {str(e)}")
+    
+    model.to(DEVICE).eval()
+    return model, tokenizer
+
+
+def _padded_batch_size(size: int) -> int:
+    """Round a batch size up to a power of two, capped at INFERENCE_BATCH_SIZE"""
+    return min(1 << (size - 1).bit_length(), config.INFERENCE_BATCH_SIZE)
+
+
+def _predict(model, tokenizer, texts: List[str]) -> List[List[float]]:
+    """
+    Tokenize (truncated to the model's context) and classify texts in batches
+    Returns: per-text class probabilities indexed like model.config.id2label
+    """
+    # CUDA graphs in compiled models record one graph per input shape, so
+    # bucket batch sizes and sequence lengths to keep that set small
+    bucket_shapes = hasattr(model, '_orig_mod')
+    
+    probabilities = []
+    for start in range(0, len(texts), config.INFERENCE_BATCH_SIZE):
+        batch = texts[start:start + config.INFERENCE_BATCH_SIZE]
+        size = len(batch)
+        if bucket_shapes:
+            batch = batch + [''] * (_padded_batch_size(size) - size)
+        
+        inputs = tokenizer(
+            batch,
+            truncation=True,
+            max_length=config.MAX_TOKEN_LENGTH,
+            padding=True,
+            pad_to_multiple_of=config.PAD_TO_MULTIPLE_OF if bucket_shapes else None,
+            return_tensors="pt"
+        ).to(DEVICE)
+        with torch.inference_mode(), _autocast():
+            logits = model(**inputs).logits
+        probabilities.extend(logits[:size].float().softmax(-1).tolist())
+    return probabilities
+
+
+def _compile_model(model):
+    """
+    Compile the model with torch.compile (compilation itself happens lazily,
+    on the first call, so callers must warm it up)
+    """
+    if not config.ENABLE_TORCH_COMPILE or not hasattr(torch, 'compile'):
+        return model
+    
+    # ONNX Runtime models are already graph-optimized
+    if not isinstance(model, torch.nn.Module):
+        return model
+    
+    # CUDA graph state is per thread, so only capture graphs when the single
+    # micro-batcher thread runs all inference; server threads calling the model
+    # directly get fused kernels without CUDA graphs
+    mode = "reduce-overhead" if config.ENABLE_MICRO_BATCHING else "max-autotune-no-cudagraphs"
+    
+    try:
+        return torch.compile(
+            model,
+            mode=mode,
+            fullgraph=False,
+            dynamic=True  # Avoid recompiling for every new text length
+        )
+    except Exception as e:
+        print(f"torch.compile unavailable, using eager model: {str(e)}")
+        return model
+
+
+def _warm_up(predict_fn) -> None:
+    """Run one batch of every bucketed batch size through predict_fn"""
+    batch_sizes = sorted({_padded_batch_size(n) for n in range(1, config.INFERENCE_BATCH_SIZE + 1)})
+    for batch_size in batch_sizes:
+        predict_fn(["warmup text"] * batch_size)
+
+
+class ResultCache:
+    """Thread-safe exact-match LRU cache of analysis results keyed on (mode, text)"""
+    
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+    
+    @staticmethod
+    def _key(mode: str, text: str) -> Tuple[str, bytes]:
+        return mode, hashlib.blake2b(text.encode('utf-8'), digest_size=16).digest()
+    
+    def get(self, mode: str, text: str) -> Optional[Dict]:
+        """Return a copy of the cached result with a fresh timestamp, or None"""
+        if not config.ENABLE_RESULT_CACHE:
+            return None
+        
+        key = self._key(mode, text)
+        with self._lock:
+            cached = self._entries.get(key)
+            if cached is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+        
+        # Copy so the cached entry itself is never mutated
+        result = copy.copy(cached)
+        result['timestamp'] = datetime.now().isoformat()
+        return result
+    
+    def put(self, mode: str, text: str, result: Dict) -> None:
+        """Cache a successful result, evicting the least recently used entry"""
+        if not config.ENABLE_RESULT_CACHE or 'error' in result:
+            return
+        
+        key = self._key(mode, text)
+        with self._lock:
+            self._entries[key] = copy.copy(result)
+            self._entries.move_to_end(key)
+            if len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+    
+    def clear(self) -> None:
+        """Drop all cached results and reset hit/miss counters"""
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+    
+    def stats(self) -> Dict:
+        """Cache size and hit rate"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._entries),
+                'max_size': self.maxsize,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0
+            }
+
+
+result_cache = ResultCache(config.RESULT_CACHE_SIZE)
+
+
+class MicroBatcher:
+    """
+    Continuous batching for concurrent requests
+    A single scheduler thread groups texts that arrive within a short window
+    into one forward pass, so concurrent server threads share model calls
+    """
+    
+    def __init__(self, predict_fn):
+        self.predict_fn = predict_fn
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name='micro-batcher', daemon=True)
+        self._thread.start()
+    
+    def predict(self, texts: List[str]) -> List[List[float]]:
+        """Queue texts for the next batches and block until all are classified"""
+        futures = []
+        for text in texts:
+            future = Future()
+            self._queue.put((text, future))
+            futures.append(future)
+        return [future.result() for future in futures]
+    
+    def _run(self):
+        max_wait = config.MICRO_BATCH_WAIT_MS / 1000
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + max_wait
+            
+            # Keep collecting until the batch is full or the window closes
+            while len(batch) < config.INFERENCE_BATCH_SIZE:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            
+            try:
+                probabilities = self.predict_fn([text for text, _ in batch])
+                for (_, future), result in zip(batch, probabilities):
+                    future.set_result(result)
+            except Exception:
+                # Batches mix texts from unrelated requests: retry each text on
+                # its own so one bad input only fails its own request
+                for text, future in batch:
+                    try:
+                        future.set_result(self.predict_fn([text])[0])
+                    except Exception as e:
+                        future.set_exception(e)
+
+
+class TransformerAnalyzer:
+    """
+    Shared load / validate / cache / classify flow for sequence classifiers
+    Subclasses set the model and task name and format class probabilities
+    """
+    
+    MODEL_NAME = None
+    TASK = None  # Used in log messages and as the result cache mode
+    ERROR_PREFIX = "Analysis failed"
     
     def __init__(self):
         self.model = None
         self.tokenizer = None
-        self.pipeline = None
+        self.labels = None
+        self.batcher = None
+        self._load_lock = threading.Lock()
         
     def _load_model(self):
-        """Lazy load the sentiment model"""
-        if self.pipeline is None:
-            print(f"Loading sentiment model: {config.SENTIMENT_MODEL}")
-            self.pipeline = pipeline(
-                "sentiment-analysis",
-                model=config.SENTIMENT_MODEL,
-                tokenizer=config.SENTIMENT_MODEL,
-                device=0 if torch.cuda.is_available() else -1
-            )
-            print("Sentiment model loaded successfully!")
+        """Lazy load the model"""
+        if self.model is not None:
+            return
+        
+        # Concurrent first requests must not each load a copy of the model
+        with self._load_lock:
+            if self.model is not None:
+                return
+            
+            print(f"Loading {self.TASK} model: {self.MODEL_NAME}")
+            model, self.tokenizer = _load_classifier(self.MODEL_NAME)
+            # Resolve labels once instead of on every prediction
+            self.labels = [self._map_label(label) for _, label in sorted(model.config.id2label.items())]
+            compiled = _compile_model(model)
+            predict_fn = functools.partial(_predict, compiled, self.tokenizer)
+            if config.ENABLE_MICRO_BATCHING:
+                self.batcher = MicroBatcher(predict_fn)
+            
+            if compiled is not model:
+                # Pay the compilation (and CUDA graph capture) cost at load time,
+                # on the same thread that will serve requests
+                try:
+                    _warm_up(self.batcher.predict if self.batcher is not None else predict_fn)
+                    model = compiled
+                except Exception as e:
+                    print(f"torch.compile failed, using eager model: {str(e)}")
+                    if self.batcher is not None:
+                        self.batcher.predict_fn = functools.partial(_predict, model, self.tokenizer)
+            self.model = model
+            print(f"{self.TASK.capitalize()} model loaded successfully!")
     
-    def analyze_sentiment(self, text: str) -> Dict:
+    def _map_label(self, label: str) -> str:
+        """Human-readable name for a model label"""
+        return label
+    
+    def _format_probabilities(self, probabilities: List[float]) -> Dict:
+        """Map class probabilities for one text to a result dict"""
+        raise NotImplementedError
+    
+    def _classify(self, texts: List[str]) -> List[List[float]]:
+        """Class probabilities per text, via the micro-batcher when enabled"""
+        if self.batcher is not None:
+            return self.batcher.predict(texts)
+        return _predict(self.model, self.tokenizer, texts)
+    
+    def analyze_batch(self, texts: List[str]) -> List[Dict]:
         """
-        Analyze sentiment of text
-        Returns: dict with label, confidence, and all scores
+        Analyze multiple texts in batched forward passes
+        Returns: list of results in input order; invalid texts get an error dict
         """
-        # Validate input
-        is_valid, message = utils.validate_text_input(text, config.MAX_TEXT_LENGTH)
-        if not is_valid:
-            return {'error': message}
+        results = [None] * len(texts)
+        valid_indices = []
+        cleaned_texts = []
+        
+        # Validate each text up front so one bad item doesn't fail the batch
+        for i, text in enumerate(texts):
+            is_valid, message = utils.validate_text_input(text, config.MAX_TEXT_LENGTH)
+            if not is_valid:
+                results[i] = {'error': message}
+                continue
+            
+            # Identical text always yields the same prediction
+            cleaned_text = utils.clean_text(text)
+            cached = result_cache.get(self.TASK, cleaned_text)
+            if cached is not None:
+                results[i] = cached
+            else:
+                valid_indices.append(i)
+                cleaned_texts.append(cleaned_text)
         
-        # Clean text
-        cleaned_text = utils.clean_text(text)
+        if not cleaned_texts:
+            return results
         
         # Load model if not loaded
         self._load_model()
         
-        # Get prediction
         try:
-            result = self.pipeline(cleaned_text, top_k=None)
-            
-            # Cardiff NLP model uses LABEL_0, LABEL_1, LABEL_2
-            # Map to human-readable labels
-            label_mapping = {
-                'LABEL_0': 'negative',
-                'LABEL_1': 'neutral',
-                'LABEL_2': 'positive',
-                # Also support already-mapped labels
-                'negative': 'negative',
-                'neutral': 'neutral',
-                'positive': 'positive'
-            }
-            
-            # Pipeline returns a list of list: [[{label, score}, ...]]
-            # Get the first (and only) result for single text input
-            predictions = result[0] if isinstance(result[0], list) else result
-            
-            # Parse results and map labels
-            all_scores = {}
-            for item in predictions:
-                mapped_label = label_mapping.get(item['label'], item['label'].lower())
-                all_scores[mapped_label] = item['score']
-            
-            top_result = max(predictions, key=lambda x: x['score'])
-            top_label = label_mapping.get(top_result['label'], top_result['label'].lower())
-            
-            return utils.format_sentiment_result(
-                label=top_label,
-                score=top_result['score'],
-                all_scores=all_scores
-            )
+            batch_probabilities = self._classify(cleaned_texts)
+            for i, cleaned_text, probabilities in zip(valid_indices, cleaned_texts, batch_probabilities):
+                results[i] = self._format_probabilities(probabilities)
+                result_cache.put(self.TASK, cleaned_text, results[i])
         except Exception as e:
             import traceback
             traceback.print_exc()  # Debug: print full traceback
-            return {'error': f"Analysis failed: {str(e)}"}
+            for i in valid_indices:
+                results[i] = {'error': f"{self.ERROR_PREFIX}: {str(e)}"}
+        
+        return results
+
+
+class SentimentAnalyzer(TransformerAnalyzer):
+    """Sentiment Analysis using RoBERTa model"""
+    
+    MODEL_NAME = config.SENTIMENT_MODEL
+    TASK = 'sentiment'
+    
+    # Cardiff NLP model uses LABEL_0, LABEL_1, LABEL_2
+    # Map to human-readable labels
+    LABEL_MAPPING = {
+        'LABEL_0': 'negative',
+        'LABEL_1': 'neutral',
+        'LABEL_2': 'positive',
+        # Also support already-mapped labels
+        'negative': 'negative',
+        'neutral': 'neutral',
+        'positive': 'positive'
+    }
+    
+    def analyze_sentiment(self, text: str) -> Dict:
+        """
+        Analyze sentiment of text
+        Returns: dict with label, confidence, and all scores
+        """
+        return self.analyze_batch([text])[0]
     
     def batch_analyze(self, texts: List[str]) -> List[Dict]:
         """Analyze multiple texts"""
-        return [self.analyze_sentiment(text) for text in texts]
+        return self.analyze_batch(texts)
+    
+    def _map_label(self, label: str) -> str:
+        return self.LABEL_MAPPING.get(label, label.lower())
+    
+    def _format_probabilities(self, probabilities: List[float]) -> Dict:
+        # Highest score first
+        scores = sorted(zip(self.labels, probabilities), key=lambda x: x[1], reverse=True)
+        top_label, top_score = scores[0]
+        
+        return utils.format_sentiment_result(
+            label=top_label,
+            score=top_score,
+            all_scores=dict(scores)
+        )
 
 
-class EmotionAnalyzer:
+class EmotionAnalyzer(TransformerAnalyzer):
     """Emotion Detection using DistilRoBERTa model"""
     
-    def __init__(self):
-        self.pipeline = None
-        
-    def _load_model(self):
-        """Lazy load the emotion model"""
-        if self.pipeline is None:
-            print(f"Loading emotion model: {config.EMOTION_MODEL}")
-            self.pipeline = pipeline(
-                "text-classification",
-                model=config.EMOTION_MODEL,
-                tokenizer=config.EMOTION_MODEL,
-                top_k=None,
-                device=0 if torch.cuda.is_available() else -1
-            )
-            print("Emotion model loaded successfully!")
+    MODEL_NAME = config.EMOTION_MODEL
+    TASK = 'emotion'
+    ERROR_PREFIX = "Emotion analysis failed"
     
     def analyze_emotion(self, text: str) -> Dict:
         """
         Detect emotions in text
         Returns: dict with primary emotion and all emotion scores
         """
-        # Validate input
-        is_valid, message = utils.validate_text_input(text, config.MAX_TEXT_LENGTH)
-        if not is_valid:
-            return {'error': message}
-        
-        # Clean text
-        cleaned_text = utils.clean_text(text)
-        
-        # Load model if not loaded
-        self._load_model()
-        
-        # Get prediction
-        try:
-            result = self.pipeline(cleaned_text)
-            
-            # Parse results
-            emotions = {item['label']: item['score'] for item in result[0]}
-            
-            return utils.format_emotion_result(emotions)
-        except Exception as e:
-            return {'error': f"Emotion analysis failed: {str(e)}"}
+        return self.analyze_batch([text])[0]
+    
+    def _format_probabilities(self, probabilities: List[float]) -> Dict:
+        # Highest score first
+        emotions = dict(sorted(zip(self.labels, probabilities), key=lambda x: x[1], reverse=True))
+        return utils.format_emotion_result(emotions)
 
 
 class AspectBasedAnalyzer:
     """Aspect-based sentiment analysis"""
     
-    def __init__(self):
-        self.sentiment_analyzer = SentimentAnalyzer()
+    def __init__(self, sentiment_analyzer: SentimentAnalyzer):
+        # Shared with the top-level analyzer so the model is only loaded once
+        self.sentiment_analyzer = sentiment_analyzer
         
     def analyze_aspects(self, text: str) -> Dict:
         """
@@ -154,28 +504,37 @@ class AspectBasedAnalyzer:
         if not is_valid:
             return {'error': message}
         
+        cached = result_cache.get('aspect', text)
+        if cached is not None:
+            return cached
+        
         # Extract aspects
         aspects = utils.extract_aspects(text)
         
-        # Analyze overall sentiment for context
-        overall_sentiment = self.sentiment_analyzer.analyze_sentiment(text)
-        
         # For each aspect, try to find relevant sentences
-        aspect_sentiments = []
-        
         sentences = text.split('.')
+        relevant_sentences = utils.group_sentences_by_aspect(sentences)
         
+        # The 'overall' fallback isn't in the aspect pattern; scan for it directly
         for aspect in aspects:
-            # Find sentences mentioning this aspect
-            relevant_sentences = [s for s in sentences if aspect in s.lower()]
-            
-            if relevant_sentences:
-                # Analyze sentiment of these sentences
-                aspect_text = '. '.join(relevant_sentences)
-                sentiment = self.sentiment_analyzer.analyze_sentiment(aspect_text)
-            else:
-                # Use overall sentiment
-                sentiment = overall_sentiment
+            if aspect not in utils.COMMON_ASPECTS:
+                matches = [s for s in sentences if aspect in s.lower()]
+                if matches:
+                    relevant_sentences[aspect] = matches
+        aspect_texts = {
+            aspect: '. '.join(relevant_sentences[aspect])
+            for aspect in aspects if aspect in relevant_sentences
+        }
+        
+        # Overall sentiment for context plus every aspect text in one batched call;
+        # aspects without relevant sentences fall back to the overall sentiment
+        unique_texts = list(dict.fromkeys([text, *aspect_texts.values()]))
+        sentiments = dict(zip(unique_texts, self.sentiment_analyzer.analyze_batch(unique_texts)))
+        overall_sentiment = sentiments[text]
+        
+        aspect_sentiments = []
+        for aspect in aspects:
+            sentiment = sentiments[aspect_texts[aspect]] if aspect in aspect_texts else overall_sentiment
             
             aspect_sentiments.append({
                 'aspect': aspect,
@@ -184,10 +543,21 @@ class AspectBasedAnalyzer:
                 'emoji': utils.get_sentiment_color(sentiment.get('label', 'neutral'))
             })
         
-        return utils.format_aspect_result(aspect_sentiments)
+        result = utils.format_aspect_result(aspect_sentiments)
+        
+        # Failed sub-analyses degrade to neutral above; don't cache those
+        if not any('error' in sentiment for sentiment in sentiments.values()):
+            result_cache.put('aspect', text, result)
+        return result
 
 
 # Global instances (lazy loaded)
 sentiment_analyzer = SentimentAnalyzer()
 emotion_analyzer = EmotionAnalyzer()
-aspect_analyzer = AspectBasedAnalyzer()
+aspect_analyzer = AspectBasedAnalyzer(sentiment_analyzer)
+
+
+def preload_models():
+    """Load (and warm up) every model so the first request doesn't pay for it"""
+    sentiment_analyzer._load_model()
+    emotion_analyzer._load_model()
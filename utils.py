@@ -4,20 +4,46 @@ Utility functions for text processing and analysis
 
 import re
 import json
+from collections import Counter
 from datetime import datetime
 from typing import List, Dict, Any
 
 
+# Precompiled patterns for clean_text (hot path on every request)
+_URL_RE = re.compile(r'http\S+|www\.\S+')
+_PUNCT_RE = re.compile(r'([!?.]){2,}')
+
+
+# Common subjects in reviews
+COMMON_ASPECTS = [
+    'food', 'service', 'staff', 'price', 'quality', 'location',
+    'product', 'delivery', 'packaging', 'support', 'experience',
+    'design', 'performance', 'battery', 'camera', 'screen',
+    'sound', 'value', 'customer service', 'ambiance', 'menu'
+]
+
+# Zero-width lookahead so overlapping aspects ('customer service' and
+# 'service') are all reported, matching a plain substring test per aspect.
+# Only one alternative can match per position, so no aspect may be a
+# prefix of another.
+assert not any(
+    a != b and b.startswith(a) for a in COMMON_ASPECTS for b in COMMON_ASPECTS
+), "COMMON_ASPECTS entries must not be prefixes of one another"
+_ASPECT_RE = re.compile(
+    '(?=(' + '|'.join(map(re.escape, sorted(COMMON_ASPECTS, key=len, reverse=True))) + '))'
+)
+
+
 def clean_text(text: str) -> str:
     """Clean and preprocess text for analysis"""
     # Remove extra whitespace
     text = " ".join(text.split())
     
     # Remove URLs
-    text = re.sub(r'http\S+|www\.\S+', '', text)
+    text = _URL_RE.sub('', text)
     
     # Remove excessive punctuation
-    text = re.sub(r'([!?.]){2,}', r'\1', text)
+    text = _PUNCT_RE.sub(r'\1', text)
     
     return text.strip()
 
@@ -27,26 +53,25 @@ def extract_aspects(text: str) -> List[str]:
     Extract key aspects/entities from text for aspect-based sentiment analysis
     Simple implementation using common patterns
     """
-    aspects = []
-    
-    # Common aspect patterns (nouns typically)
-    words = text.lower().split()
-    
-    # Common subjects in reviews
-    common_aspects = [
-        'food', 'service', 'staff', 'price', 'quality', 'location',
-        'product', 'delivery', 'packaging', 'support', 'experience',
-        'design', 'performance', 'battery', 'camera', 'screen',
-        'sound', 'value', 'customer service', 'ambiance', 'menu'
-    ]
-    
-    for aspect in common_aspects:
-        if aspect in text.lower():
-            aspects.append(aspect)
+    # Single pass over the lowercased text for all aspects
+    found = set(_ASPECT_RE.findall(text.lower()))
+    aspects = [aspect for aspect in COMMON_ASPECTS if aspect in found]
     
     return aspects if aspects else ['overall']
 
 
+def group_sentences_by_aspect(sentences: List[str]) -> Dict[str, List[str]]:
+    """
+    Map each aspect to the sentences that mention it
+    Lowercases and scans every sentence exactly once
+    """
+    relevant = {}
+    for sentence in sentences:
+        for aspect in set(_ASPECT_RE.findall(sentence.lower())):
+            relevant.setdefault(aspect, []).append(sentence)
+    return relevant
+
+
 def format_sentiment_result(label: str, score: float, all_scores: Dict[str, float]) -> Dict[str, Any]:
     """Format sentiment analysis results"""
     return {
@@ -84,13 +109,10 @@ def calculate_overall_sentiment(sentiments: List[str]) -> str:
     if not sentiments:
         return 'neutral'
     
-    counts = {
-        'positive': sentiments.count('positive'),
-        'negative': sentiments.count('negative'),
-        'neutral': sentiments.count('neutral')
-    }
+    # Single counting pass instead of one list scan per label
+    counts = Counter(sentiments)
     
-    return max(counts.items(), key=lambda x: x[1])[0]
+    return max(('positive', 'negative', 'neutral'), key=lambda label: counts[label])
 
 
 def export_to_json(data: Any, filename: str = None) -> str: